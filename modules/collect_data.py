@@ -10,7 +10,7 @@
 	angles and distances between object triplets in each frame.
 	Requires JSON label files in the json folder.'''
 
-import os, json, random, sys, urllib.request, re, gc
+import os, json, random, sys, urllib.request, re, gc, functools
 
 from io import BytesIO
 import fnmatch
@@ -28,6 +28,7 @@ from PIL import Image, ImageDraw
 from os import makedirs, listdir
 from os.path import join, isfile, isdir, dirname, abspath, splitext, exists
 from itertools import permutations
+from concurrent.futures import ProcessPoolExecutor
 
 from modules import menu
 from modules import import_tools as imp
@@ -37,6 +38,24 @@ from modules import progress_bar
 
 ## declare objects ---------------------------------------------- ##
 
+@functools.lru_cache(maxsize=8)
+def cameraRays(intrinsics,width,height):
+    '''imp.pixelRays for a flattened intrinsics tuple, cached so that all frames
+    of a sequence processed by the same process share one ray grid (read-only)'''
+    rays = imp.pixelRays(np.reshape(intrinsics,(3,3)),width,height)
+    rays.setflags(write=False)
+    return rays
+
+@functools.lru_cache(maxsize=8)
+def pixelGrid(width,height):
+    '''(width,height,2) array where [x,y] holds pixel (x,y); flattened it runs
+    in column-major order. Shared by every frame of the same size (read-only)'''
+    xx, yy = np.indices((width,height),dtype=np.int32)
+    grid = np.stack([xx,yy],axis=-1)
+    grid.setflags(write=False)
+    return grid
+
+
 class Frame:
     '''represents a single frame'''
 
@@ -46,31 +65,40 @@ class Frame:
         self.row = []	       # a list of y values
         self.col = []          # a list of x values
         self.data = []         # a list of data corresponding to x and y location
+        self.occupied = set()  # set of (y,x) locations that already have data
         self.width = width     # width of frame (y)
         self.height = height   # height of frame (x)
         self.loc = None        # location of recording
         self.objects = []      # objects in frame
         self.labels = {}       # {objectName : (x,y) centroid} pairs (2D)
         self.centroids = {}    # {objectName : (x,y,z) centroids in meters} (3D)
-        self.objects3d = {}    # {objectName : [(x,y,z)...(x,y,z)] } all 3d points
+        self.objects3d = {}    # {objectName : (k,3) array of x,y,z } all 3d points
         self.combos = []       # list of [labelA,labelB,labelC,angZAB,angZAC,angBAC,distAB]
         self.intrinsics = []   # camera intrinsics
         self.extrinsics = []   # camera extrinsics
         self.image = None      # image to export
+        self.indices = None    # (height,width) array of palette indices for each pixel
+        self.palette = [(0,0,0,0)] # colours of the objects in frame (0 is transparent)
+        self.paletteIndex = {} # {objectName : index into palette}
         self.background = None # original image
         self.depthMap = None   # depth map
-        self.xyzCamera = []    # xyz camera coords for entire frame
-        self.xyz = []          # xyz world coords for entire frame
-        self.valid = []        # valid world coords corresponding to each [x,y] location
+        self.xyzCamera = None  # (N,3) array of xyz camera coords for entire frame
+        self.xyz = None        # (N,3) array of xyz world coords for entire frame
+        self.valid = None      # flat bool array of valid coords for each [x,y] location (column-major)
+        self.pixelColors = []  # DataFrames of background colour counts for each polygon
 
     def addData(self,data,x,y):
         '''add data at specified x,y location'''
         self.row.append(y)
         self.col.append(x)
         self.data.append(data)
+        self.occupied.add((y,x))
 
     def addObject(self,obj):
         self.objects.append(obj)
+        if obj.nameStr not in self.paletteIndex:
+            self.paletteIndex[obj.nameStr] = len(self.palette)
+            self.palette.append(obj.colour)
 
     def extract_pixel_colors(self,name,coords):
         # Create a mask image of the same size as the original image
@@ -100,36 +128,34 @@ class Frame:
             data['G'].append(color[1])
             data['B'].append(color[2])
             data['count'].append(count)
-        df = pd.DataFrame(data)
-        obj_colors_filename = './data/object_colors.csv'
-        if exists(obj_colors_filename):
-            # combine counts from previous runs and re-save csv
-            df_old = pd.read_csv(obj_colors_filename)
-            df_new = pd.concat([df_old,df])
-            df = df_new.groupby(['object_name', 'R', 'G', 'B'], as_index=False)['count'].sum().reset_index()
-        if 'index' in df.columns:
-            df.drop(columns=['index'],inplace=True)
-        df.to_csv(obj_colors_filename,index=False)
-
-
-    def update(self):
-        '''update matrix and image'''
-        dataNames = [x.ID for x in self.data]
-        self.image = Image.new('RGBA',(self.width,self.height))
-        pix = self.image.load()
-        for i,pixel in enumerate(zip(self.col, self.row)):
-            pix[pixel[0]-1,pixel[1]-1] = self.data[i].colour
+        return pd.DataFrame(data)
+
+
+    def update(self,rays):
+        '''update matrix and image
+        rays:       per-pixel camera rays for this frame size (see imp.pixelRays)'''
+        # store a palette index per pixel, expanded to RGBA when drawing polygons
+        dtype = np.uint8 if len(self.palette) <= 256 else np.uint16
+        self.indices = np.zeros((self.height,self.width),dtype=dtype)
+        rows = np.asarray(self.row,dtype=np.intp) - 1
+        cols = np.asarray(self.col,dtype=np.intp) - 1
+        self.indices[rows,cols] = [self.paletteIndex[d.nameStr] for d in self.data]
         # camera coords
         sys.stdout.write("\tretrieving camera coords:"); sys.stdout.flush()
         t1 = startTimer() #time to retrieve camera coords
-        cameraCoords = imp.depth2XYZcamera(self.intrinsics,self.depthMap)
-        self.xyzCamera = imp.getCameraCoords(cameraCoords)
+        cameraCoords = rays * self.depthMap[...,None]
+        valid = self.depthMap != 0
+        # keep the valid points in column-major pixel order
+        self.xyzCamera = np.transpose(cameraCoords,(1,0,2))[valid.T]
+        del cameraCoords # free the full-frame array before the world transform
         sys.stdout.write("\t%s\n"%str(endTimerPretty(t1))); sys.stdout.flush()
         # world coords
         sys.stdout.write("\tconverting to world coords:"); sys.stdout.flush()
         t2 = startTimer() #time to change from camera to world coords
-        (xyzWorld,self.valid) = imp.camera2XYZworld(cameraCoords,self.extrinsics)
-        self.xyz = np.transpose(xyzWorld)
+        xyzWorld = imp.transformPointCloud(self.xyzCamera,self.extrinsics)
+        self.xyz = np.ascontiguousarray(np.transpose(xyzWorld))
+        # column-major so that the n-th True entry corresponds to self.xyz[n]
+        self.valid = valid.ravel(order='F')
         sys.stdout.write("\t%s\n"%str(endTimerPretty(t2))); sys.stdout.flush()
         return self # to enable cascading
 
@@ -140,40 +166,28 @@ class Frame:
         t4 = startTimer() #time to calculate the 2D and 3D centroids
         # Get 2D centroids (to place labels in correct place in image)
         for name,coords in polygons.items():
-            centX = sum([x for (x,y) in coords])/len(coords)
-            centY = sum([y for (x,y) in coords])/len(coords)
+            centX, centY = np.asarray(coords).mean(axis=0)
             self.labels[name] = (centX,centY)
         # Get 3D centroids (using only the points visible in current frame)
-        rangeX = range(self.height)
-        rangeY = range(self.width)
-        template = [(y,x) for y in rangeY for x in rangeX]
+        # pixel grid in column-major order, the same order as the valid camera coords
+        template = pixelGrid(self.width,self.height)
+        xyz = self.xyzCamera # Uses xyz camera coords (self.xyz for world coords)
         for name, allCoords in polygons.items():
             coords = [c for c in allCoords if c[0]<self.width \
 		      and c[1]<self.height and c[0]>=0 and c[1]>=0]
             if not coords: continue
             vertices = path.Path(coords,closed=True)
-            objectPts = vertices.contains_points(template)
-            objectPts = np.reshape(objectPts,(self.width,self.height))
-            count = 0
-            pts3d = []
-            for y,col in enumerate(objectPts):
-                for x,row in enumerate(col):
-                    if row and self.valid[x][y]:
-                        #xyzCoords = self.xyz[count] # Uses xyz world coords
-                        xyzCoords = self.xyzCamera[count] # Uses xyz camera coords
-                        pts3d.append(xyzCoords)
-                    if self.valid[x][y]:
-                        count+=1
-            X = [item[0] for item in pts3d]
-            Y = [item[1] for item in pts3d]
-            Z = [item[2] for item in pts3d]
-            if len(X) == 0:
+            # only pixels within the polygon's bounding box can be inside it
+            (x0,y0),(x1,y1) = np.min(coords,axis=0),np.max(coords,axis=0)+1
+            inBox = vertices.contains_points(template[x0:x1,y0:y1].reshape(-1,2))
+            objectPts = np.zeros((self.width,self.height),dtype=bool)
+            objectPts[x0:x1,y0:y1] = inBox.reshape(x1-x0,y1-y0)
+            # keep the object's pixels that have depth, indexed into the valid points
+            pts3d = xyz[objectPts.ravel()[self.valid]]
+            if len(pts3d) == 0:
                 continue
-            X = sum(X)/len(X)
-            Y = sum(Y)/len(Y)
-            Z = sum(Z)/len(Z)
             self.objects3d[name] = pts3d
-            self.centroids[name] = (X,Y,Z)
+            self.centroids[name] = tuple(pts3d.mean(axis=0).tolist())
 
         sys.stdout.write("\t\t%s\n"%str(endTimerPretty(t4))); sys.stdout.flush()
         return self
@@ -184,17 +198,17 @@ class Frame:
         polygons:   a dictionary of object_name:[(x,y)..(x,y)] pairs'''
         sys.stdout.write("\tdrawing polygons:"); sys.stdout.flush()
         t6 = startTimer() #time to draw polygons
-        if self.image == None:
+        if self.indices is None:
             print("ERROR: Can't draw to empty image! (update first)")
         else:
+            palette = np.array(self.palette,dtype=np.uint8)
+            self.image = Image.fromarray(palette[self.indices],'RGBA')
             draw = ImageDraw.Draw(self.image)
+            byName = {o.nameStr: o for o in self.objects}
             for name,coord in polygons.items():
-                colour = (255,255,255,140)
-                for o in self.objects:
-                    if str(o.getName()) == name:
-                        colour = o.colour
-                # extract pixel colors and store in memory as csv
-                self.extract_pixel_colors(name,coord)
+                colour = byName[name].colour if name in byName else (255,255,255,140)
+                # extract pixel colors (saved to csv by saveObjectColors)
+                self.pixelColors.append(self.extract_pixel_colors(name,coord))
                 # draw the colored polygon
                 draw.polygon(coord,fill=colour)
             for name,coord in self.labels.items():
@@ -220,8 +234,9 @@ class Frame:
         sys.stdout.write("\tprocessing 3d data:"); sys.stdout.flush()
         t7 = startTimer() #time to process 3d data
         saveLoc = join(filePath,str(self.ID))
-        plotFile = open(saveLoc+'.3d','w')
+        plotFile = open(saveLoc+'.3d','w',buffering=1<<20)
         patches = []
+        byName = {o.nameStr: o for o in self.objects}
         #-----------------------------------------------#
         if plot:
             if not exists(saveLoc+'/'):
@@ -232,22 +247,21 @@ class Frame:
             #fig.clf()
         #-----------------------------------------------#
         for name, coords in self.objects3d.items():
-            plotFile.write(str(name))
-            for i, coord in enumerate(coords):
-                coord = "\n"+str(tuple(coord))
-                plotFile.write(coord)
-            plotFile.write("\n")
+            # one write per object: name followed by one (x, y, z) line per point
+            lines = [str(name)] + [str(tuple(coord)) for coord in coords.tolist()]
+            plotFile.write("\n".join(lines)+"\n")
             #---------------------------------------------------------------#
             if not plot: continue
             # get colour
             colour = [1,1,1]
-            for o in self.objects:
-                if str(o.getName()) == name:
-                    colour = [float(c)/255 for c in o.colour[:-1]]
-                    patches.append(mpatches.Patch(color=colour,label=name))
-            xyz = np.transpose(np.array(coords))
-            if xyz.size > 0:
-                ax.scatter([xyz[0]],[xyz[1]],[xyz[2]],color=colour,marker='.',alpha=0.003)
+            if name in byName:
+                colour = [float(c)/255 for c in byName[name].colour[:-1]]
+                patches.append(mpatches.Patch(color=colour,label=name))
+            if coords.size > 0:
+                # every view re-renders the scatter, so plot at most 50k points per object
+                if coords.shape[0] > 50000:
+                    coords = coords[np.random.choice(coords.shape[0],50000,replace=False)]
+                ax.scatter(coords[:,0],coords[:,1],coords[:,2],color=colour,marker='.',alpha=0.003,rasterized=True)
             if name in self.centroids:
                 xyzCen = self.centroids[name] # add centroid
                 ax.scatter([xyzCen[0]],[xyzCen[1]],[xyzCen[2]],color=[0,0,0],marker='x')
@@ -270,6 +284,8 @@ class Frame:
                 ax.azim+=int(360/plot)
             sys.stdout.write("\t\t%s\n"%str(endTimerPretty(t8))); sys.stdout.flush()
         plt.close()
+        if plot:
+            gc.collect() # figures hold reference cycles, so free this one right away
         #------------------------------------------------------------------#
         return self
 
@@ -286,42 +302,38 @@ class Frame:
             if obj in frameObjects:
                 self.centroids[obj] = [row['X'],row['Y'],row['Z']]
 
-        names = []
-        for name, _ in self.centroids.items():
-            names.append(name)
-        combos = []
-        for combo in permutations(names,3):
-            combos.append('---'.join(combo).split('---'))
-        for combo in combos:
-            A = np.array(self.centroids[combo[0]])
-            B = np.array(self.centroids[combo[1]])
-            C = np.array(self.centroids[combo[2]])
-            O = np.array([0,0,0])
-            BA = B - A
-            CA = C - A
-            OA = O - A
-            # distance AB, AC, AO
-            distAB = np.linalg.norm(A-B)
-            distAC = np.linalg.norm(A-C)
-            distAO = np.linalg.norm(A-O)
-            # angle BAC
-            cosBAC   = np.dot(BA, CA) / (np.linalg.norm(BA) * np.linalg.norm(CA))
-            angleBAC = np.degrees(np.arccos(cosBAC))
-            # angle OAB
-            cosOAB   = np.dot(OA, BA) / (np.linalg.norm(OA) * np.linalg.norm(BA))
-            angleOAB = np.degrees(np.arccos(cosOAB))
-            # angle OAC
-            cosOAC   = np.dot(OA, CA) / (np.linalg.norm(OA) * np.linalg.norm(CA))
-            angleOAC = np.degrees(np.arccos(cosOAC))
-            # add to self.combos and format label names
-            nameA = combo[0].lstrip("[").rstrip("]").replace("'","").split(",")
-            nameA = "_".join([nameA[0].replace(" ","_"),nameA[1].replace(" ","")])
-            nameB = combo[1].lstrip("[").rstrip("]").replace("'","").split(",")
-            nameB = "_".join([nameB[0].replace(" ","_"),nameB[1].replace(" ","")])
-            nameC = combo[2].lstrip("[").rstrip("]").replace("'","").split(",")
-            nameC = "_".join([nameC[0].replace(" ","_"),nameC[1].replace(" ","")])
-            self.combos.append([nameA,nameB,nameC,str(distAB),str(distAC),str(distAO),\
-                                str(angleBAC),str(angleOAB),str(angleOAC)])
+        names = list(self.centroids.keys())
+        if len(names) < 3:
+            return self
+        # compute every triplet at once: row p of A, B, C holds the centroids
+        # of the p-th permutation of (objectA, objectB, objectC)
+        cen = np.array([self.centroids[n] for n in names],dtype=np.float64)
+        idx = np.array(list(permutations(range(len(names)),3)))
+        A = cen[idx[:,0]]
+        B = cen[idx[:,1]]
+        C = cen[idx[:,2]]
+        BA = B - A
+        CA = C - A
+        OA = -A # camera is at the origin
+        vecs = np.stack([BA,CA,OA])
+        # distance AB, AC, AO in one call
+        distAB, distAC, distAO = np.linalg.norm(vecs,axis=2)
+        # dot products BA.CA, OA.BA, OA.CA in one call
+        dotBAC, dotOAB, dotOAC = np.einsum('kij,kij->ki',vecs[[0,2,2]],vecs[[1,0,1]])
+        # angle BAC
+        angleBAC = np.degrees(np.arccos(np.clip(dotBAC / (distAB * distAC),-1,1)))
+        # angle OAB
+        angleOAB = np.degrees(np.arccos(np.clip(dotOAB / (distAO * distAB),-1,1)))
+        # angle OAC
+        angleOAC = np.degrees(np.arccos(np.clip(dotOAC / (distAO * distAC),-1,1)))
+        values = np.column_stack([distAB,distAC,distAO,angleBAC,angleOAB,angleOAC]).tolist()
+        # format each label name once rather than once per triplet
+        labels = []
+        for name in names:
+            label = name.lstrip("[").rstrip("]").replace("'","").split(",")
+            labels.append("_".join([label[0].replace(" ","_"),label[1].replace(" ","")]))
+        for (a,b,c), vals in zip(idx.tolist(), values):
+            self.combos.append([labels[a],labels[b],labels[c]]+[str(v) for v in vals])
         #sys.stdout.write("\t\t%s\n"%str(endTimerPretty(t5))); sys.stdout.flush()
         return self
 
@@ -354,13 +366,23 @@ class Frame:
         df = pd.DataFrame.from_dict(comboDict)
         df.to_csv(join(filePath,str(self.ID)+'.csv'), index=False)
 
-        # export image file
-        image = self.image
+        # export image file (processFrame writes it instead when the background has been dropped)
+        self.exportImage(filePath)
+        #sys.stdout.write("\t\t%s\n"%str(endTimerPretty(t9))); sys.stdout.flush()
+        return self
+
+    def exportImage(self,filePath):
+        '''export the polygons drawn over the background as a jpg
+        filePath:   the path to the file'''
         if self.background:
-            image = Image.alpha_composite(self.background,image).convert('RGB')
+            # blend the polygons over the (opaque) background in one numpy pass
+            bg = np.asarray(self.background, dtype=np.uint8)[...,:3].astype(np.uint16)
+            fg = np.asarray(self.image, dtype=np.uint8).astype(np.uint16)
+            alpha = fg[...,3:4]
+            rgb = (fg[...,:3]*alpha + bg*(255-alpha) + 127)//255
+            image = Image.fromarray(rgb.astype(np.uint8), 'RGB')
             image.save(join(filePath,str(self.ID)+'.jpg'))
             image.close()
-        #sys.stdout.write("\t\t%s\n"%str(endTimerPretty(t9))); sys.stdout.flush()
         return self
 
 
@@ -370,6 +392,8 @@ class SceneObject:
     def __init__(self, ID, name):
         self.ID = ID
         self.name = name
+        self.nameList = self.splitName() # name in format: [object,identifier]
+        self.nameStr = str(self.nameList) # key for this object in per-frame dictionaries
         self.colour = self.setRandomColour()
         self.frames = {}
         self.oldIDs = []
@@ -394,8 +418,8 @@ class SceneObject:
                 B+=100
         return (R,G,B,140) # return in RGBA format (transparency hard-coded at 140)
 
-    # get object name in format: [object,identifier]
-    def getName(self):
+    # split object name into format: [object,identifier]
+    def splitName(self):
         splitName = self.name.split(':')
         n = 0
         while n < len(splitName):
@@ -405,7 +429,11 @@ class SceneObject:
             splitName.append(None)
         return splitName
 
-    # add Frame to frames dictionary
+    # get object name in format: [object,identifier]
+    def getName(self):
+        return self.nameList
+
+    # add frame number to frames dictionary
     def addFrame(self,location,f):
         if location not in self.frames:
             self.frames[location] = []
@@ -530,6 +558,124 @@ def calculateCentroidsForScene(pathTo3dFiles,allObjects):
     progress_bar.update(100,100,suffix=' '*(30+maxNameLength))
 
 
+## SET TO TRUE TO CALCULATE CENTROIDS ON A SCENE LEVEL (WORLD COORDS)
+sceneCentroids = False
+
+
+def initWorker():
+    '''discard the output of a worker process, since the per-step timings of
+    frames processed in parallel would be interleaved, and keep the objects
+    loaded at startup (modules etc.) out of the garbage collector's scans'''
+    sys.stdout = open(os.devnull,'w')
+    gc.freeze()
+
+
+def processFrame(frameNum, image, depth, local, framePolygons, K, extrinsics, loc, datasetName, filePath, plot):
+    '''process a single frame (run in a worker process by processJSON)
+    framePolygons:  a list of (SceneObject,[x..x],[y..y]) for each polygon in the frame
+    extrinsics:     camera extrinsics for this frame
+    loc:            name of the scene the frame belongs to
+    returns the processed frame, without its per-pixel data, and a list of
+    DataFrames with the pixel colour counts of each polygon'''
+    frameTimer = startTimer()
+    sys.stdout.write("\nCalculating Frame "+frameNum+" coordinates...\n")
+    sys.stdout.write("\tgathering frame data:"); sys.stdout.flush()
+
+    if local:
+        background = Image.open(image,'r').convert('RGBA')
+    else:
+        background = Image.open(BytesIO(urllib.request.urlopen(image).read())).convert('RGBA')
+
+    (width,height) = background.size
+
+    # ---------------------------------------------------- #
+    # create frame and fill with data
+
+    currentFrame = Frame(frameNum,width,height)
+    currentFrame.loc = loc
+    currentFrame.background = background
+    currentFrame.depthMap = imp.depthRead(depth,local)
+    currentFrame.intrinsics = K
+    currentFrame.extrinsics = extrinsics
+    exceptions   = []
+    conflicts    = []
+    polygons     = {}
+    for currentObject, xs, ys in framePolygons:
+        objName = currentObject.getName()
+        # round all vertices at once (np.rint rounds halves to even, like round)
+        xs = np.rint(xs).astype(np.int32)
+        ys = np.rint(ys).astype(np.int32)
+        polygons[currentObject.nameStr] = list(zip(xs.tolist(), ys.tolist()))
+        inBounds = (xs > 0) & (xs <= width) & (ys > 0) & (ys <= height)
+        for x, y in zip(xs[inBounds].tolist(), ys[inBounds].tolist()):
+            if (y,x) in currentFrame.occupied:
+                conflicts.append(str([(x,y),objName]))
+            else:
+                currentFrame.addData(currentObject,x,y)
+        exceptions.extend(str([(x,y),objName]) for x, y in
+                          zip(xs[~inBounds].tolist(), ys[~inBounds].tolist()))
+        currentFrame.addObject(currentObject)
+
+    sys.stdout.write("\t\t%s\n"%str(endTimerPretty(frameTimer)));
+    sys.stdout.flush()
+    rays = cameraRays(tuple(np.ravel(K).tolist()),width,height)
+    currentFrame = (currentFrame.update(rays)
+                           .calculateCentroids(polygons)
+                           .drawPolygons(polygons,datasetName)
+                           .process3dPoints(filePath,plot))
+
+    # uncomment to save exceptions and conflicts to files
+    #np.savetxt(join(filePath,frameNum+'.ex'),exceptions,fmt="%s")
+    #np.savetxt(join(filePath,frameNum+'.co'),conflicts,fmt="%s")
+    sys.stdout.write("\ttotal time for frame %s:"%str(currentFrame.ID))
+    sys.stdout.write(" \t%s"%str(endTimerPretty(frameTimer))); sys.stdout.flush()
+
+    # the scene-level export happens after all frames are back, without the images
+    # dropped below, so write the frame's image now
+    if sceneCentroids:
+        currentFrame.exportImage(filePath)
+
+    # drop the per-pixel data before the frame is sent back to the main process
+    pixelColors = currentFrame.pixelColors
+    currentFrame.pixelColors = []
+    currentFrame.depthMap = currentFrame.xyzCamera = currentFrame.xyz = currentFrame.valid = None
+    currentFrame.indices = None
+    currentFrame.objects3d = {}
+    currentFrame.row, currentFrame.col, currentFrame.data = [], [], []
+    currentFrame.occupied = set()
+    currentFrame.background.close()
+    currentFrame.background = currentFrame.image = None
+    return currentFrame, pixelColors
+
+
+def saveObjectColors(pixelColors):
+    '''add pixel colour counts to the object colours csv
+    pixelColors:    a list of DataFrames returned by Frame.extract_pixel_colors'''
+    if not pixelColors:
+        return
+    df = pd.concat(pixelColors)
+    obj_colors_filename = './data/object_colors.csv'
+    if exists(obj_colors_filename):
+        # combine counts from previous runs and re-save csv
+        df_old = pd.read_csv(obj_colors_filename)
+        df = pd.concat([df_old,df])
+    df = df.groupby(['object_name', 'R', 'G', 'B'], as_index=False)['count'].sum()
+    df.to_csv(obj_colors_filename,index=False)
+
+
+def loadJSON(jsonPath):
+    '''load a json label file, with the polygon vertices as numpy arrays
+    jsonPath:       the path to the json file'''
+    with open(jsonPath,'rb') as jData:
+        data = json.loads(jData.read())
+    for f in data['frames']:
+        if not f: continue
+        for polygon in f['polygon']:
+            polygon['x'] = np.asarray(polygon['x'],dtype=np.float64)
+            polygon['y'] = np.asarray(polygon['y'],dtype=np.float64)
+    return data
+
+
 def processJSON(data, allObjects, currentPath, datasetName, local, plot):
     '''process each json file
     data:           the data contained in the json file
@@ -596,103 +742,80 @@ def processJSON(data, allObjects, currentPath, datasetName, local, plot):
 
     imageList = data['fileList']
     prefixes = [im.split('-')[0] for im in imageList]
+    prefixSet = set(prefixes)
 
     if local:
         depthList = listdir(depthPath)
     else:
         depthList = sorted(list(set(re.compile(r'[0-9]*\-[0-9]*\.png').findall(urllib.request.urlopen(depthPath).read().decode('utf-8')))))
 
-    depthList = [d for d in depthList if d.split('-')[0] in prefixes]
+    depthList = [d for d in depthList if d.split('-')[0] in prefixSet]
+    depthByPrefix = {d.split('-')[0]: d for d in depthList} # {frame prefix : depth file}
 
     if len(imageList)!=len(depthList)!=len(frames):
         print('ERROR: Cannot process JSON. Frame or depth image files missing.')
         return allObjects
 
-    allFrames = []
+    if local:
+        filePath = join('data',name)
+    else:
+        filePath = join('data',datasetName,name)
+    try:
+        makedirs(filePath)
+    except OSError:
+        if not isdir(filePath):
+            raise
+
+    # resolve each frame's objects here so that all frames share the same objects
+    # (and colours), then process the frames themselves in parallel
+    objectsByName = {o.name: o for o in allObjects} # {name : SceneObject} for fast lookup
+    tasks = []
     #for i, f in enumerate(frames[:14]):
     for i, f in enumerate(frames):
         if i in emptyFrames:
             continue
-        frameTimer = startTimer()
-
         image = join(imagePath,imageList[i])
-        depth = join(depthPath,depthList[i])
+        depth = join(depthPath,depthByPrefix[prefixes[i]])
         frameNum = str(int(image.split('/')[-1].split('-')[0]))
-
-        sys.stdout.write("\nCalculating Frame "+frameNum+" coordinates...\n")
-        sys.stdout.write("\tgathering frame data:"); sys.stdout.flush()
-
-        if local:
-            background = Image.open(image,'r').convert('RGBA')
-        else:
-            background = Image.open(BytesIO(urllib.request.urlopen(image).read())).convert('RGBA')
-
-        (width,height) = background.size
-
-        # ---------------------------------------------------- #
-        # create frame and fill with data
-
-        currentFrame = Frame(frameNum,width,height)
-        currentFrame.loc = data['name']
-        currentFrame.background = background
-        currentFrame.depthMap = imp.depthRead(depth,local)
-        currentFrame.intrinsics = K
-        currentFrame.extrinsics = extrinsicsC2W[i] if extrinsics_incl_cur_frames_only else extrinsicsC2W[int(frameNum)-1]
-        exceptions   = []
-        conflicts    = []
-        polygons     = {}
+        extrinsics = extrinsicsC2W[i] if extrinsics_incl_cur_frames_only else extrinsicsC2W[int(frameNum)-1]
+        framePolygons = []
         for polygon in f['polygon']:
             ID = polygon['object']
-            exists = False
-            for o in allObjects:
-                if objects[ID]['name'] == o.name:
-                    currentObject = o
-                    currentObject.updateID(ID)
-                    exists = True
-                    break
-            if not exists: # new object
+            currentObject = objectsByName.get(objects[ID]['name'])
+            if currentObject is None: # new object
                 currentObject = SceneObject(ID,objects[ID]['name'])
                 allObjects.append(currentObject)
-            polygons[str(currentObject.getName())] = []
-            currentObject.addFrame(name,currentFrame)
-            for j, x in enumerate(polygon['x']):
-                x = int(round(x))
-                y = int(round(polygon['y'][j]))
-                polygons[str(currentObject.getName())].append((x,y))
-                if 0 < x <= width and 0 < y <= height:
-                    if (y,x) in zip(currentFrame.row,currentFrame.col):
-                        conflicts.append(str([(x,y),currentObject.getName()]))
-                    else:
-                        currentFrame.addData(currentObject,x,y)
-                else:
-                    exceptions.append(str([(x,y),currentObject.getName()]))
-            currentFrame.addObject(currentObject)
+                objectsByName[currentObject.name] = currentObject
+            else:
+                currentObject.updateID(ID)
+            currentObject.addFrame(name,frameNum)
+            framePolygons.append((currentObject,polygon['x'],polygon['y']))
+        tasks.append((frameNum,image,depth,local,framePolygons,K,extrinsics,
+                      data['name'],datasetName,filePath,plot))
 
-        if local:
-            filePath = join('data',name)
-        else:
-            filePath = join('data',datasetName,name)
+    allFrames = []
+    pixelColors = []
+    if tasks:
+        progress_bar.update(0,len(tasks),prefix='Processing frames:')
+        # the returned frames only add to the heap, so don't let the garbage
+        # collector rescan them after every few allocations
+        gc.disable()
         try:
-            makedirs(filePath)
-        except OSError:
-            if not isdir(filePath):
-                raise
-        sys.stdout.write("\t\t%s\n"%str(endTimerPretty(frameTimer)));
-        sys.stdout.flush()
-        currentFrame = (currentFrame.update()
-                               .calculateCentroids(polygons)
-                               .drawPolygons(polygons,datasetName)
-                               .process3dPoints(filePath,plot))
-
-        allFrames.append(currentFrame)
-        # uncomment to save exceptions and conflicts to files
-        #np.savetxt(join(filePath,str(i)+'.ex'),exceptions,fmt="%s")
-        #np.savetxt(join(filePath,str(i)+'.co'),conflicts,fmt="%s")
-        sys.stdout.write("\ttotal time for frame %s:"%str(currentFrame.ID))
-        sys.stdout.write(" \t%s"%str(endTimerPretty(frameTimer))); sys.stdout.flush()
-
-    ## SET TO TRUE TO CALCULATE CENTROIDS ON A SCENE LEVEL (WORLD COORDS)
-    if False:
+            with ProcessPoolExecutor(max_workers=os.cpu_count(),initializer=initWorker) as executor:
+                futures = [executor.submit(processFrame,*task) for task in tasks]
+                for n, future in enumerate(futures):
+                    currentFrame, frameColors = future.result()
+                    allFrames.append(currentFrame)
+                    pixelColors.extend(frameColors)
+                    progress_bar.update(n+1,len(tasks),prefix='Processing frames:',\
+                                        suffix='frame %s (%s)'%(currentFrame.ID,endTimerPretty(jsonTimer)))
+                    if (n+1) % 50 == 0:
+                        gc.collect()
+        finally:
+            gc.enable()
+    saveObjectColors(pixelColors)
+
+    if sceneCentroids:
         pathTo3dFiles = join('data',datasetName,data['name'])
         calculateCentroidsForScene(pathTo3dFiles,allObjects)
 
@@ -731,9 +854,8 @@ def main():
         #for jNum,jFile in enumerate(jsonFiles):
         for jNum,jFile in enumerate(jsonFiles):#[0:1]):
             startB = startTimer()
-            with open(join(jsonDir,jFile)) as jData:
-                data = json.load(jData)
-                allObjects = processJSON(data,allObjects,currentPath,datasetName,local,plot) # process each json file
+            data = loadJSON(join(jsonDir,jFile))
+            allObjects = processJSON(data,allObjects,currentPath,datasetName,local,plot) # process each json file
             print("\n** File processed in %s."% str(endTimerPretty(startB)))
             print("** Total: "+str(jNum+1)+ " files processed in %s." % str(endTimerPretty(startA)))
             print("**",len(allObjects),"total objects in %s JSON files.\n" % str(jNum+1))
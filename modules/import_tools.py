@@ -3,7 +3,6 @@ from os import listdir
 from os.path import join
 import json
 import shutil
-import gc
 import re
 import ssl
 ssl._create_default_https_context = ssl._create_unverified_context # for Mac compatibility
@@ -47,7 +46,6 @@ def depthRead(filename,local):
     bitshift = [[(d >> 3) or (d << 16-3) for d in row] for row in depthmap]
      # divide values by 1000 to go from millimeters to meters
     depthmap = np.array([[float(d)/1000 for d in row] for row in bitshift])
-    gc.collect()
     return depthmap
 
 #K=np.array([[525,0,320],[0,525,240],[0,0,1]])
@@ -67,44 +65,42 @@ def depth2XYZcamera(K,depth):
     XYZcamera.append(depth) # units of z_coords is meters
 
     # XYZcamera[3]: valid points for each pixel location
-    valid = [[int(bool(n)) for n in row] for row in depth]
+    valid = (depth != 0).astype(int)
     XYZcamera.append(valid)
 
     return XYZcamera
 
 
+def pixelRays(K,width,height):
+    # camera ray through each pixel, scaled so that multiplying by the depth map
+    # gives the same x,y,z camera coords as depth2XYZcamera. Depends only on K and
+    # the frame size, so it can be computed once and reused for every frame
+    [x,y] = np.meshgrid(range(0,width),range(0,height))
+    rays = np.stack([(x - K[0, 2]) / K[0, 0],
+                     (y - K[1, 2]) / K[1, 1],
+                     np.ones((height,width))],axis=-1)
+    return rays
+
+
 def getCameraCoords(XYZcamera):
-    XYZ = []
-    for j in range(0,len(XYZcamera[0][0])):
-        for i in range(0,len(XYZcamera[0])):
-            if XYZcamera[3][i][j]:
-                data = (XYZcamera[0][i][j],
-                        XYZcamera[1][i][j],
-                        XYZcamera[2][i][j])
-                XYZ.append(data)
-    XYZ = np.array(XYZ)
+    # (N,3) array of the valid points, in column-major pixel order
+    valid = np.asarray(XYZcamera[3],dtype=bool).T
+    XYZ = np.stack([np.asarray(c).T[valid] for c in XYZcamera[:3]],axis=1)
     return XYZ
 
 
 def camera2XYZworld(XYZcamera,extrinsics):
-    XYZ = []
-    for j in range(0,len(XYZcamera[0][0])):
-        for i in range(0,len(XYZcamera[0])):
-            if XYZcamera[3][i][j]:
-                data = (XYZcamera[0][i][j],
-                        XYZcamera[1][i][j],
-                        XYZcamera[2][i][j])
-                XYZ.append(data)
-    XYZ = np.array(XYZ)
+    XYZ = getCameraCoords(XYZcamera)
     XYZworld = transformPointCloud(XYZ,extrinsics)
     vals = (XYZworld,XYZcamera[3])
     return vals
 
 
 def transformPointCloud(XYZ,Rt):
-    rotation = [(float(r[0]),float(r[1]),float(r[2])) for r in Rt]
-    translation = np.array(Rt)[:3,3]
-    return np.matmul(rotation,np.transpose(XYZ)) + np.repeat(np.reshape(translation,(3,1)),XYZ.shape[0],axis=1)
+    Rt = np.asarray(Rt,dtype=float)
+    rotation = Rt[:3,:3]
+    translation = Rt[:3,3]
+    return np.matmul(rotation,np.transpose(XYZ)) + translation[:,None]
 
 #main_folder = './data/washington/scene_01'
 #fname='scene_01'
@@ -120,7 +116,7 @@ def project_annotations_3D_to_2D(main_folder, fname ,jsonDir, annot_files, nFram
 
     pcd = PlyData.read(pcloudfile)
     pcd_data = pcd.elements[0].data
-    point_cloud = np.asarray([pcd_data['x'],pcd_data['y'],pcd_data['z']],dtype='float64').T
+    point_cloud = np.asarray([pcd_data['x'],pcd_data['y'],pcd_data['z']],dtype='float32').T
     camera_poses = np.loadtxt(posfile)
     lbls = np.loadtxt(lblfile)[1:]
 
@@ -13,6 +13,7 @@
 	to incomplete 3d data). Requires output from collect_data.py.'''
 
 import fnmatch
+import functools
 import copy
 import os
 from os.path import join
@@ -20,13 +21,15 @@ import sys
 import ast
 import pickle
 import json
+import re
 import random
 import math
-from math import sqrt
+import mmap
 import numpy as np
 import pandas as pd
 from collections import Counter
 from itertools import permutations
+from concurrent.futures import ProcessPoolExecutor
 
 from modules.timer import *
 from modules import progress_bar
@@ -36,26 +39,26 @@ def gatherTriplets():
     # gather all triplet values into a single file =======================###
     print("Gathering all triplets into single file...")
     timer = startTimer()
-    files = []
-    for root, dirnames, filenames in os.walk('data'):
-        for filename in fnmatch.filter(filenames, '*.csv'):
-            files.append(os.path.join(root, filename))
-
-    files = sorted(f for f in files if not ('data/object_' in f or
-                   'data/triplets' in f or f=='data/working-combos.csv' or
-                   'centroids.csv' in f))
-    files.sort(key=len)
-
-    master_df = pd.DataFrame()
+    files = [os.path.join(root, filename) for root, dirnames, filenames in os.walk('data')
+             for filename in fnmatch.filter(filenames, '*.csv')]
+    files = [f for f in files if not ('data/object_' in f or
+             'data/triplets' in f or f=='data/working-combos.csv' or
+             'centroids.csv' in f)]
+    # sort by filename length, then alphabetically, as this correctly sorts number strings
+    files.sort(key=lambda f: (len(f), f))
+
+    dfs = []
     for i, filename in enumerate(files):
         print(filename)
-        df = pd.read_csv(filename)
-        df['objectA'] = df['objectA'].apply(lambda x: x.rsplit('_',1)[0])
-        df['objectB'] = df['objectB'].apply(lambda x: x.rsplit('_',1)[0])
-        df['objectC'] = df['objectC'].apply(lambda x: x.rsplit('_',1)[0])
-        master_df = pd.concat([master_df,df])
+        df = pd.read_csv(filename,dtype={'objectA':str,'objectB':str,'objectC':str})
+        df['objectA'] = df['objectA'].str.rsplit('_',n=1).str[0]
+        df['objectB'] = df['objectB'].str.rsplit('_',n=1).str[0]
+        df['objectC'] = df['objectC'].str.rsplit('_',n=1).str[0]
+        dfs.append(df)
         progress_bar.update(i+1,len(files),suffix=filename+'                       ')
 
+    # concatenate once, rather than copying the accumulated rows for every file
+    master_df = pd.concat(dfs,ignore_index=True) if dfs else pd.DataFrame()
     master_df.sort_values(by=list(master_df.columns)).to_csv('./data/triplets.csv', index=False)
     sys.stdout.write("Done! (%s)\n"%str(endTimerPretty(timer))); sys.stdout.flush()
 
@@ -69,66 +72,97 @@ def averageTriplets():
     for root, dirnames, filenames in os.walk('data'):
         for filename in fnmatch.filter(filenames, '*.csv'):
             files.append(os.path.join(root, filename))
-    files = sorted(files)
+    # skip these because they are the output of the current script
+    files = sorted(f for f in files if not ('data/object_' in f or 'data/triplets' in f or
+                   f=='data/working-combos.csv' or 'centroids.csv' in f))
 
-    averages = {}
+    objCols = ['objectA','objectB','objectC']
+    dfs = []
     for filename in files:
-        if 'data/object_' in filename or 'data/triplets' in filename or filename=='data/working-combos.csv' or 'centroids.csv' in filename:
-            continue # skip these because they are the output of the current script
-        df_trip = pd.read_csv(filename)
-
-        # Column name cleanup - not necessary if original CSV files were saved using pandas
-        df_trip.columns = [c.strip() for c in df_trip.columns] # remove extra spaces around names
-        df_trip.to_csv(filename,index=False)
-
-        for i, row in df_trip.iterrows():
-            objA = row['objectA'].rsplit('_',1)[0]
-            objB = row['objectB'].rsplit('_',1)[0]
-            objC = row['objectC'].rsplit('_',1)[0]
-            triplet = ','.join([objA,objB,objC])
-            distAB = float(row['distanceAB'])
-            distAC = float(row['distanceAC'])
-            distAO = float(row['distanceAO'])
-            angBAC = float(row['angleOAB'])
-            angOAB = float(row['angleOAC'])
-            angOAC = float(row['angleBAC'])
-            if triplet not in averages:
-                averages[triplet] = [[distAB],[distAC],[distAO],[angBAC],[angOAB],[angOAC],1]
-                continue
-            averages[triplet][0].append(distAB)
-            averages[triplet][1].append(distAC)
-            averages[triplet][2].append(distAO)
-            averages[triplet][3].append(angBAC)
-            averages[triplet][4].append(angOAB)
-            averages[triplet][5].append(angOAC)
-            averages[triplet][6]+=1
-
-    triplets = {'objectA':[],'objectB':[],'objectC':[],'distanceAB':[],'distanceAC':[],
-                'distanceAO':[],'angleBAC':[],'angleOAB':[],'angleOAC':[],'count':[]}
-
-    for triplet, values in averages.items():
-        objA, objB, objC = triplet.split(',')
-        triplets['objectA'].append(objA)
-        triplets['objectB'].append(objB)
-        triplets['objectC'].append(objC)
-        triplets['distanceAB'].append(sum(values[0])/values[6])
-        triplets['distanceAC'].append(sum(values[1])/values[6])
-        triplets['distanceAO'].append(sum(values[2])/values[6])
-        triplets['angleBAC'].append(sum(values[3])/values[6])
-        triplets['angleOAB'].append(sum(values[4])/values[6])
-        triplets['angleOAC'].append(sum(values[5])/values[6])
-        triplets['count'].append(values[6])
-
-    df_triplets = pd.DataFrame(triplets)
+        # skipinitialspace and the strip remove extra spaces around names, which
+        # are only present if the original CSV files were not saved using pandas
+        df_trip = pd.read_csv(filename,skipinitialspace=True,dtype={c:str for c in objCols})
+        df_trip.columns = [c.strip() for c in df_trip.columns]
+        dfs.append(df_trip)
+
+    columns = ['objectA','objectB','objectC','distanceAB','distanceAC',
+               'distanceAO','angleBAC','angleOAB','angleOAC','count']
+    if dfs:
+        df_all = pd.concat(dfs,ignore_index=True)
+        for col in objCols:
+            # remove object suffix, then group on integer category codes rather than strings
+            df_all[col] = df_all[col].str.rsplit('_',n=1).str[0].astype('category')
+        # average every triplet in order of first appearance (Frame.export saves
+        # angles BAC, OAB and OAC under the columns angleOAB, angleOAC, angleBAC)
+        df_triplets = df_all.groupby(objCols,sort=False,observed=True,as_index=False).agg(
+            distanceAB=('distanceAB','mean'),distanceAC=('distanceAC','mean'),
+            distanceAO=('distanceAO','mean'),angleBAC=('angleOAB','mean'),
+            angleOAB=('angleOAC','mean'),angleOAC=('angleBAC','mean'),
+            count=('distanceAB','size'))[columns]
+        df_triplets[objCols] = df_triplets[objCols].astype(str)
+    else:
+        df_triplets = pd.DataFrame(columns=columns)
     df_triplets.to_csv('./data/triplets_avg.csv', index=False)
 
+    # pickle as a dictionary of lists, {column : [values]}
     with open ('data/triplets_avg.pickle','wb') as handle:
-        pickle.dump(triplets,handle,protocol=pickle.HIGHEST_PROTOCOL)
-    handle.close()
+        pickle.dump(df_triplets.to_dict(orient='list'),handle,protocol=pickle.HIGHEST_PROTOCOL)
 
     sys.stdout.write("Done! (%s)\n"%str(endTimerPretty(timer))); sys.stdout.flush()
 
 
+def objectDistances(filename,centroids,cenFile):
+    '''distances of each object's 3d points in a .3d file from its centroid
+    filename:   the .3d file
+    centroids:  {object : centroid} for the file's scene
+    cenFile:    the centroids file the centroids came from (for error messages)
+    returns {object name : [arrays of distances]}'''
+    # a .3d file has a name line, e.g. ['chair', '1'], followed by one (x, y, z) line per point;
+    # names are the only lines starting with a bracket and a quote, and take the whole line
+    # since they can contain brackets themselves. Older files may also have a name straight
+    # after a point, e.g. (x, y, z)['chair', '1'] (bytes patterns, to scan the mmap)
+    nameLine = re.compile(rb"(?:^|(?<=\)))[ \t]*[\[(][ \t]*['\"].*$",re.M)
+    number = rb"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+    pointLine = re.compile(rb"[\[(]\s*(%s)\s*,\s*(%s)\s*,\s*(%s)\s*[\])]"%(number,number,number))
+
+    points = {} # each object's 3d points
+    distances = {}
+    if os.path.getsize(filename) == 0:
+        return distances # an empty file can't be memory-mapped (and has no points)
+    theFile = open(filename,'rb')
+    # scan the file in place rather than reading it into a string
+    contents = mmap.mmap(theFile.fileno(),0,access=mmap.ACCESS_READ)
+    names = list(nameLine.finditer(contents))
+    for i, match in enumerate(names):
+        try:
+            # keyed exactly like calculateCentroidsForScene, which writes centroids.csv
+            # ('(' and ')' inside names become '[' and ']')
+            line = match.group().decode('utf-8')
+            name = repr(list(json.loads(line.replace("'","\"").replace('(','[').replace(')',']').replace('None','null'))))
+        except Exception as e:
+            print(match.group())
+            raise e
+        # the object's points lie between its name and the next one
+        end = names[i+1].start() if i+1 < len(names) else len(contents)
+        pts = np.array(pointLine.findall(contents,match.end(),end),dtype=np.float64).reshape(-1,3)
+        if len(pts) > 0:
+            points.setdefault(name,[]).append(pts)
+    contents.close()
+    theFile.close()
+
+    for obj,pts in points.items():
+        try:
+            centroid = centroids[obj]
+        except Exception as e:
+            print(cenFile)
+            print(obj)
+            raise e
+        dist = np.linalg.norm(np.concatenate(pts)-centroid,axis=1)
+        newName = ast.literal_eval(obj)[0].replace(' ','_')
+        distances.setdefault(newName,[]).append(dist)
+    return distances
+
+
 def approximateObjectSizes():
     # approximate object sizes =============================###
 
@@ -143,56 +177,27 @@ def approximateObjectSizes():
         for filename in fnmatch.filter(filenames,'*centroids.csv'):
             cenFiles.append(os.path.join(root,filename))
 
-    files3D.sort() # regular in-place sort first
-    files3D.sort(key=len) # then sort by filename length, as this correctly sorts number strings alphabetically
+    files3D.sort(key=lambda f: (len(f), f)) # sort by filename length, then alphabetically, as this correctly sorts number strings
 
-    cenFiles.sort()
-    cenFiles.sort(key=len)
+    cenFiles.sort(key=lambda f: (len(f), f))
     cen_dfs = {f:pd.read_csv(f) for f in cenFiles}
+    # {centroid file : {object : (3,) array of its centroid}}
+    cen_lookup = {f:dict(zip(df['object'].tolist(),df[['X','Y','Z']].to_numpy(dtype=np.float64)))
+                  for f,df in cen_dfs.items()}
 
     progress_bar.update(0,len(files3D),prefix='Progress:')
     sizes = {}
-    for index, filename in enumerate(files3D):
-        sceneDir = filename.rsplit('/',1)[0]
-        cen_df = cen_dfs[join(sceneDir,'centroids.csv')]
-        centroids = {c['object']:[c['X'],c['Y'],c['Z']] for _,c in cen_df.iterrows()}
-        theFile = open(filename,'r')
-        contents = theFile.read()
-        contents = contents.replace(')[',')\n[').replace(') [',')\n[')
-        lines = contents.splitlines()
-        distances = {} # of each object's 3d points from centroid
-        for line in lines:
-            if line=='':
-                continue
-            try:
-                elem = list(json.loads(line.replace("'","\"").replace('(','[').replace(')',']').replace('None','null')))
-            except Exception as e:
-                print(line)
-                raise e
-            if len(elem)!=3:
-                name = repr(elem).rstrip('\n')
-            else:
-                try:
-                    x1,y1,z1 = [centroids[name][0],centroids[name][1],centroids[name][2]]
-                except Exception as e:
-                    print(cenFile)
-                    print(name)
-                    raise e
-                x2,y2,z2 = [elem[0],elem[1],elem[2]]
-                if name not in distances:
-                    distances[name] = [sqrt((x2-x1)**2 + (y2-y1)**2 + (z2-z1)**2)]
-                    continue
-                distances[name].append(sqrt((x2-x1)**2 + (y2-y1)**2 + (z2-z1)**2))
-
-        for obj,dist in distances.items():
-            newName = ast.literal_eval(obj)[0].replace(' ','_')
-            if newName not in sizes:
-                sizes[newName] = dist
-                continue
-            sizes[newName].extend(dist)
-        theFile.close()
-        progress_bar.update(index,len(files3D),\
-                            prefix='Progress:',suffix=str(index)+'/'+str(len(files3D)))
+    # the files are independent, so measure them in parallel; map returns them in order
+    # so that objects (and their distances) are merged in the same order every time
+    cenFiles3D = [join(filename.rsplit('/',1)[0],'centroids.csv') for filename in files3D]
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(objectDistances,files3D,[cen_lookup[f] for f in cenFiles3D],
+                               cenFiles3D,chunksize=8)
+        for index, distances in enumerate(results):
+            for newName,dists in distances.items():
+                sizes.setdefault(newName,[]).extend(dists)
+            progress_bar.update(index,len(files3D),\
+                                prefix='Progress:',suffix=str(index)+'/'+str(len(files3D)))
 
     progress_bar.update(len(files3D),len(files3D),\
                          prefix='Progress:',suffix=str(len(files3D))+'/'+str(len(files3D)))
@@ -208,32 +213,24 @@ def approximateObjectSizes():
     # vals.plot(kind='bar')
     # plt.show()
 
-    #mean_sizes = {}
-    median_sizes = {}
-    #mode_sizes = {}
-    for obj,dist in sizes.items():
-        numObjects = len(dist)
-        vals = pd.Series(dist).sort_values().reset_index(drop=True)
+    names = list(sizes.keys())
+    diameters = np.empty(len(names)) # median of each object's distances
+    counts = np.empty(len(names),dtype=np.int64) # number of points for each object
+    for i,dist in enumerate(sizes.values()):
+        vals = np.sort(np.concatenate(dist))
+        counts[i] = len(vals)
         vals = vals[:len(vals)-int(len(vals)/5)] # trim 20% off the larger end to exclude outliers
-        #multiply by 2 below to change radius to diameter
-        #mean_sizes[obj] = str(vals.mean()*2)+','+str(numObjects)
-        median_sizes[obj] = str(vals.median())+','+str(numObjects) # removed the x2 to make values more reasonable
-        #mode = vals.mode()
-        #mode = mode if isinstance(mode,int) else mode[int(len(mode)/2)]
-        #mode_sizes[obj] = str(mode*2)+','+str(numObjects)
-
-    maxCount = max([int(x.split(',')[-1]) for x in median_sizes.values()])
-    maxDiameter = max([float(x.split(',')[0]) for x in median_sizes.values()])
-    #meanDiameter = np.mean([float(x.split(',')[0]) for x in mean_sizes.values()])
-    medianDiameter = np.median([float(x.split(',')[0]) for x in median_sizes.values()])
-
-    outFile = open("data/object_sizes.csv",'w')
-    outFile.write("object,diameter,count,confidence\n")
-    for obj,dist in median_sizes.items():
-        diameter = float(dist.split(',')[0]) if float(dist.split(',')[0])>0 else medianDiameter
-        confidence = (int(dist.split(',')[-1])/maxCount) * (maxDiameter/diameter)
-        outFile.write(obj+','+str(dist)+','+str(confidence)+'\n')
-    outFile.close()
+        # (the median is not multiplied by 2 to change radius to diameter, to make values more reasonable)
+        diameters[i] = np.median(vals)
+
+    maxCount = counts.max()
+    maxDiameter = diameters.max()
+    medianDiameter = np.median(diameters)
+
+    # objects without a measurable size get the median diameter for their confidence
+    confidence = (counts/maxCount) * (maxDiameter/np.where(diameters>0,diameters,medianDiameter))
+    pd.DataFrame({'object':names,'diameter':diameters,'count':counts,'confidence':confidence})\
+      .to_csv("data/object_sizes.csv",index=False)
     sys.stdout.write("Processed in %s\n"%str(endTimerPretty(timer)));
     sys.stdout.flush()
 
@@ -270,22 +267,44 @@ def suffix_duplicates(items,nested=False):
     return result
 
 
-def loadObjectSizes(objects):
+@functools.lru_cache(maxsize=2)
+def loadSizeCategories(path,mtime):
+    '''load the manually assigned size category of each object (first entry wins),
+    once per modification time of the file (mtime is only part of the cache key)
+    returns {object : size category} and {size category : (min,max) diameter}'''
     cat_dict = {
         'sizecat': {0: 'xsmall', 1: 'small', 2: 'medium', 3: 'large', 4: 'xlarge'},
         'min':     {0: 0.08,     1: 0.2,     2: 0.4,      3: 0.7,     4: 1.3},
         'max':     {0: 0.30,     1: 0.6,     2: 1.2,      3: 1.7,     4: 3.0}}
         #'min': {0: 0.08, 1: 0.2, 2: 0.35, 3: 1.0, 4: 2.0},
         #'max': {0: 0.25, 1: 0.5, 2: 1.2, 3: 3.0, 4: 5.0}}
-    df_cats = pd.DataFrame.from_dict(cat_dict)
-    df_sizes = pd.read_csv('./data/object_sizes_manual.csv')
+    cat_ranges = {cat:(cat_dict['min'][i],cat_dict['max'][i]) for i,cat in cat_dict['sizecat'].items()}
+    df_sizes = pd.read_csv(path).drop_duplicates(subset='object',keep='first')
+    size_cats = dict(zip(df_sizes['object'],df_sizes['sizecat']))
+    return size_cats, cat_ranges
+
+
+@functools.lru_cache(maxsize=2)
+def loadTripletSamples(path,mtime):
+    '''load triplets.csv once per modification time (mtime is only part of the cache key)
+    returns {(objectA,objectB,objectC) : list of the measured triplet values}'''
+    df = pd.read_csv(path)
+    keys = zip(df['objectA'].tolist(),df['objectB'].tolist(),df['objectC'].tolist())
+    values = df[['distanceAB','distanceAC','distanceAO','angleBAC','angleOAB','angleOAC']].to_numpy().tolist()
+    samples = {}
+    for k, v in zip(keys,values):
+        samples.setdefault(k,[]).append(v)
+    return samples
+
+
+def loadObjectSizes(objects):
+    sizesPath = './data/object_sizes_manual.csv'
+    size_cats, cat_ranges = loadSizeCategories(sizesPath,os.path.getmtime(sizesPath))
     obj_names = suffix_duplicates(objects)
     sizes = {}
     for i,obj_name in enumerate(objects):
-        obj_size_cat = df_sizes[df_sizes['object']==obj_name]['sizecat'].values[0]
-        curr_cat = df_cats[df_cats['sizecat']==obj_size_cat]
-        min_val = curr_cat['min'].values[0]
-        max_val = curr_cat['max'].values[0]
+        obj_size_cat = size_cats[obj_name]
+        min_val, max_val = cat_ranges[obj_size_cat]
         obj_size = random.triangular(min_val, max_val, (min_val + max_val) / 2)
         sizes[obj_names[i]] = [obj_size,obj_size_cat]
     return sizes
@@ -317,68 +336,46 @@ def calculateCoords(objects,method='sampling',working_combos_precalculated=True,
     if method == 'averaging':
         ## NOT RECOMMENDED: CODE OUTDATED AND UNTESTED
         pickleData = pickle.load(open("data/triplets_avg.pickle",'rb'))
-        dictionary = {}
-        for i, objA in enumerate(pickleData['objectA']):
-            objB = pickleData['objectB'][i]
-            objC = pickleData['objectC'][i]
-            comboData = [pickleData['distanceAB'][i],pickleData['distanceAC'][i],
-                pickleData['distanceAO'][i],pickleData['angleBAC'][i],
-                pickleData['angleOAB'][i],pickleData['angleOAC'][i],pickleData['count'][i]]
-            dictionary[f'{objA},{objB},{objC}'] = comboData
+        keys = zip(pickleData['objectA'],pickleData['objectB'],pickleData['objectC'])
+        values = zip(pickleData['distanceAB'],pickleData['distanceAC'],pickleData['distanceAO'],
+                     pickleData['angleBAC'],pickleData['angleOAB'],pickleData['angleOAC'],pickleData['count'])
+        dictionary = {k: list(v) for k, v in zip(keys,values)}
         print_debug and print("INFO: Loaded triplet data.")
 
     elif method == 'sampling':
 
-        df = pd.read_csv('./data/triplets.csv')
-
-        df = df.sample(frac=1).reset_index(drop=True)
-        df = df.drop_duplicates(subset=['objectA','objectB','objectC'],keep='first')
-        dictionary = {}
-        for i, row in df.iterrows():
-            objA = row['objectA']
-            objB = row['objectB']
-            objC = row['objectC']
-
-            comboData = [row['distanceAB'],row['distanceAC'],row['distanceAO'],
-                         row['angleBAC'],row['angleOAB'],row['angleOAC'],1]
-            dictionary[f'{objA},{objB},{objC}'] = comboData
+        # every recorded instance of each triplet; one is picked at random below
+        tripletsPath = './data/triplets.csv'
+        dictionary = loadTripletSamples(tripletsPath,os.path.getmtime(tripletsPath))
 
     else:
         print_debug and print(f'ERROR: Wrong method selected for calculateCoords: {method}.')
         return {}
 
-    # generate every permutation of the given objects and try to find a set
-    # of triplets that will contain enough data to calculate all object locations
-    objMix = list(permutations(objects,len(objects)))
-    random.shuffle(objMix)
+    # find a set of triplets that will contain enough data to calculate all object
+    # locations: objects A and B (tried in random order) with every other object as C.
+    # Pairs are taken by index so that duplicate objects are handled like any other.
+    pairs = list(permutations(range(len(objects)),2))
+    random.shuffle(pairs)
 
-    enoughData = True
-    for i,objs in enumerate(objMix):
+    enoughData = False
+    for i,(a,b) in enumerate(pairs):
         print_debug and print("INFO: Attempt "+str(i+1)+"...")
-        enoughData = True # set to false if any object isn't in final list
         # create list of necessary triplets based on input objects
-        combos = [[objs[0],objs[1],x] for x in objs[2:]]
-        good = []
-        for combo in combos: # for each combo
-            comboStr = ','.join(combo)
-            if comboStr not in dictionary:
-                print_debug and print("WARNING: Triplet not found in dictionary: " + comboStr)
-                continue
-            good.append(combo)
-
-        for obj in objects: # if any of the objects aren't in the final list
-            if obj not in [x for sublist in good for x in sublist]:
-                print_debug and print("ERROR: Not enough data for "+obj+". Retrying...")
-                enoughData = False
-                break
-        if enoughData:
+        combos = [[objects[a],objects[b],obj] for n,obj in enumerate(objects) if n not in (a,b)]
+        missing = [combo for combo in combos if tuple(combo) not in dictionary]
+        if combos and not missing:
+            enoughData = True
             break
+        print_debug and missing and print("WARNING: Triplet not found in dictionary: " + ','.join(missing[0]) + ". Retrying...")
 
     if not enoughData:
         print_debug and print("ERROR: All tries failed. Exiting...")
         sys.exit(1)
 
-    combos = good
+    random.shuffle(combos) # the other objects (C) in random order, the first is the base triplet
+    if method == 'sampling':
+        dictionary = {tuple(combo): random.choice(dictionary[tuple(combo)])+[1] for combo in combos}
     print_debug and print("INFO: Found good combo.")
 
     sizes = loadObjectSizes(objects)
@@ -388,13 +385,12 @@ def calculateCoords(objects,method='sampling',working_combos_precalculated=True,
     # ensure distance AB is the same for all triplets, so make it equal to mean distance AB of all triplets
     all_ab_dists = []
     for combo in combos:
-        all_ab_dists.append(float(dictionary[','.join(combo)][0]))
+        all_ab_dists.append(float(dictionary[tuple(combo)][0]))
     d_ab = np.mean(all_ab_dists) # universal distance AB for all triplets
 
     triplets = []
     for i, combo in enumerate(combos): # for each combo
-        comboStr = ','.join(combo)
-        data = dictionary[comboStr] # find triplet data
+        data = dictionary[tuple(combo)] # find triplet data
         print_debug and print("INFO: Setting up combo: "+ repr(combo))
         # set up variables
         objA,objB,objC = combos_n[i]
@@ -407,22 +403,21 @@ def calculateCoords(objects,method='sampling',working_combos_precalculated=True,
         aOAC = math.radians(float(data[5])) # angle OAC
 
         # find necessary values using trig
-        a = d_ac*math.cos(aBAC)
-        b = d_ac*math.sin(aBAC)
-        x = d_ao*math.cos(aOAB)
-        y = (d_ac*d_ao*math.cos(aOAC) - a*x) / b
-        z = math.sqrt(d_ao**2 - x**2 - y**2)
+        cosBAC, sinBAC = math.cos(aBAC), math.sin(aBAC)
+        cosOAB, cosOAC = math.cos(aOAB), math.cos(aOAC)
+        a = d_ac*cosBAC
+        b = d_ac*sinBAC
+        x = d_ao*cosOAB
+        y = (d_ac*d_ao*cosOAC - a*x) / b
+        # averaged or noisy measurements can leave the camera just off the
+        # sphere of radius d_ao, so clamp rather than fail on a negative root
+        z = math.sqrt(max(d_ao*d_ao - x*x - y*y, 0.0))
 
         # establish centroid locations for A, B, C, and camera
         A = [0,0,0]
         B = [d_ab,0,0]
         C = [a,b,0]
         O = [x,y,z]
-        # establish scale of objects so they are proportional to camera's
-        # range of sight
-        d_bc = math.sqrt(sum((B-C)**2 for B,C in zip(B,C)))
-        d_bo = math.sqrt(sum((B-O)**2 for B,O in zip(B,O)))
-        d_co = math.sqrt(sum((C-O)**2 for C,O in zip(C,O)))
         triplets.append([objA,objB,objC,A,B,C,O]) # objA,objB,objC,camera
 
     # The following process answers the question:
@@ -441,6 +436,7 @@ def calculateCoords(objects,method='sampling',working_combos_precalculated=True,
     d = [sum(z[0])/3,sum(z[1])/3,sum(z[2])/3] # trivially generated 4th point
     pts.append(d)
     baseCoords = np.array(pts,np.float32)   # use first triplet as base
+    base = np.hstack([baseCoords, np.ones((4,1))]) # pad with ones to make translations possible
     finalCoords = {} # initialize {obj: (x,y,z)} structure
     finalCoords[triplets[0][0]] = triplets[0][3] # add objA coords
     finalCoords[triplets[0][1]] = triplets[0][4] # add objB coords
@@ -448,35 +444,21 @@ def calculateCoords(objects,method='sampling',working_combos_precalculated=True,
     finalCoords['CAMERA'] = triplets[0][6] # add camera coords
 
     for triplet in triplets[1:]:
-        pts = [triplet[3],triplet[4],triplet[6]]
-        z = list(zip(pts[0],pts[1],pts[2]))
-        d = [sum(z[0])/3,sum(z[1])/3,sum(z[2])/3]
-        pts.append(d)
-        coords = np.array(pts,np.float32)
-
-        # pad with ones to make translations possible
-        pad = lambda x: np.hstack([x, np.ones((x.shape[0], 1))])
-        unpad = lambda x: x[:,:-1]
-        base = pad(baseCoords)
-        curr = pad(coords)
-        # solve the least squares problem X * A = Y
-        # to find the transformation matrix A
-        A, res, rank, s = np.linalg.lstsq(curr, base,rcond=-1)
-        transform = lambda x: unpad(np.dot(pad(x), A))
-
-        pts.append(triplet[5])            # now add objC back to the set of points
-        coords = np.array(pts,np.float32) # and re-apply the transformation so the
-        coordsNew = transform(coords)     # current triplet lines up with the base triplet
+        # objA, objB, camera, 4th point and objC, padded with ones
+        pts = np.array([triplet[3],triplet[4],triplet[6]],np.float64)
+        coords = np.vstack([pts, pts.mean(axis=0), triplet[5]]).astype(np.float32)
+        curr = np.hstack([coords, np.ones((5,1))])
+        # solve the least squares problem X * A = Y to find the transformation
+        # matrix A (the 4 points are coplanar so lstsq, not solve, is needed)
+        A = np.linalg.lstsq(curr[:4], base, rcond=-1)[0]
+        # apply the transformation to all points, including objC, so the
+        # current triplet lines up with the base triplet
+        coordsNew = np.dot(curr, A)[:,:-1]
 
         # determine the outlier - these are the coordinates for objC
-        isNear = lambda p1,p2: sum((x1 - x2)**2 for x1, x2 in zip(p1, p2)) < 0.0001
-        corresp = [] # stores all coords from coordsNew which mapped to a baseCoord
-        for coord in coordsNew.tolist():
-            for baseCoord in baseCoords.tolist():
-                if isNear(coord,baseCoord):
-                    corresp.append(coord)
-                    break
-        finalCoords[triplet[2]] = [x for x in coordsNew.tolist() if x not in corresp][0]
+        sqDists = ((coordsNew[:,None,:] - baseCoords[None,:,:])**2).sum(axis=-1)
+        corresp = sqDists.min(axis=1) < 0.0001 # coords from coordsNew which mapped to a baseCoord
+        finalCoords[triplet[2]] = coordsNew[~corresp][0].tolist()
 
     # Add these to pass color to blender - locations will be determined in blender
     finalCoords['WALL'] = tuple()
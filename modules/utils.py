@@ -1,18 +1,44 @@
 import matplotlib.pyplot as plt
 import numpy as np
 from skimage.morphology import disk
-from skimage.morphology import closing, remove_small_objects
-from skimage.measure import label
+from skimage.morphology import closing
+from scipy import ndimage as ndi
 from scipy.spatial.distance import cdist
 from scipy.optimize import linear_sum_assignment
 
+# number of set bits in each possible byte value
+popcount_table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def jaccard_distance(packed_A, packed_B):
+    '''
+    Jaccard distance between every pair of binary masks, packed with np.packbits.
+    :param packed_A: NA x nbytes packed masks
+    :param packed_B: NB x nbytes packed masks
+    :return: NA x NB array of distances, the same as cdist(..., metric='jaccard')
+    '''
+    count = lambda x: popcount_table[x].sum(axis=-1, dtype=np.int64)
+    intersection = count(packed_A[:, None, :] & packed_B[None, :, :])
+    union = count(packed_A)[:, None] + count(packed_B)[None, :] - intersection
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(union > 0, (union - intersection) / union, 0.0)
+
+
 def quaternion_to_rotation_matrix(quat):
-    a, b, c, d = quat
-    return np.array([
-        [1 - 2*(c**2 + d**2), 2*(b*c - a*d), 2*(a*c + b*d)],
-        [2*(b*c + a*d), 1 - 2*(b**2 + d**2), 2*(c*d - a*b)],
-        [2*(b*d - a*c), 2*(a*b + c*d), 1 - 2*(b**2 + c**2)]
-    ])
+    # quat can be a single (a,b,c,d) quaternion or an (N,4) array of them,
+    # giving a (3,3) or an (N,3,3) array of rotation matrices
+    a, b, c, d = np.moveaxis(np.asarray(quat, dtype=float), -1, 0)
+    R = np.empty(a.shape + (3, 3))
+    R[..., 0, 0] = 1 - 2*(c**2 + d**2)
+    R[..., 0, 1] = 2*(b*c - a*d)
+    R[..., 0, 2] = 2*(a*c + b*d)
+    R[..., 1, 0] = 2*(b*c + a*d)
+    R[..., 1, 1] = 1 - 2*(b**2 + d**2)
+    R[..., 1, 2] = 2*(c*d - a*b)
+    R[..., 2, 0] = 2*(b*d - a*c)
+    R[..., 2, 1] = 2*(a*b + c*d)
+    R[..., 2, 2] = 1 - 2*(b**2 + c**2)
+    return R
 
 
 def quaternion_rotation_matrix(Q):
@@ -20,54 +46,52 @@ def quaternion_rotation_matrix(Q):
     Convert a quaternion into a full three-dimensional rotation matrix.
 
     Input
-    :param Q: A 4 element array representing the quaternion (q0,q1,q2,q3)
+    :param Q: A 4 element array representing the quaternion (q0,q1,q2,q3),
+              or an Nx4 array of quaternions
 
     Output
-    :return: A 3x3 element matrix representing the full 3D rotation matrix.
+    :return: A 3x3 element matrix representing the full 3D rotation matrix
+             (Nx3x3 for an Nx4 input).
              This rotation matrix converts a point in the local reference
              frame to a point in the global reference frame.
     """
     # Extract the values from Q
-    q0 = Q[0]
-    q1 = Q[1]
-    q2 = Q[2]
-    q3 = Q[3]
+    q0, q1, q2, q3 = np.moveaxis(np.asarray(Q, dtype=float), -1, 0)
+    rot_matrix = np.empty(q0.shape + (3, 3))
 
     # First row of the rotation matrix
-    r00 = 2 * (q0 * q0 + q1 * q1) - 1
-    r01 = 2 * (q1 * q2 - q0 * q3)
-    r02 = 2 * (q1 * q3 + q0 * q2)
+    rot_matrix[..., 0, 0] = 2 * (q0 * q0 + q1 * q1) - 1
+    rot_matrix[..., 0, 1] = 2 * (q1 * q2 - q0 * q3)
+    rot_matrix[..., 0, 2] = 2 * (q1 * q3 + q0 * q2)
 
     # Second row of the rotation matrix
-    r10 = 2 * (q1 * q2 + q0 * q3)
-    r11 = 2 * (q0 * q0 + q2 * q2) - 1
-    r12 = 2 * (q2 * q3 - q0 * q1)
+    rot_matrix[..., 1, 0] = 2 * (q1 * q2 + q0 * q3)
+    rot_matrix[..., 1, 1] = 2 * (q0 * q0 + q2 * q2) - 1
+    rot_matrix[..., 1, 2] = 2 * (q2 * q3 - q0 * q1)
 
     # Third row of the rotation matrix
-    r20 = 2 * (q1 * q3 - q0 * q2)
-    r21 = 2 * (q2 * q3 + q0 * q1)
-    r22 = 2 * (q0 * q0 + q3 * q3) - 1
-
-    # 3x3 rotation matrix
-    rot_matrix = np.array([[r00, r01, r02],
-                           [r10, r11, r12],
-                           [r20, r21, r22]])
+    rot_matrix[..., 2, 0] = 2 * (q1 * q3 - q0 * q2)
+    rot_matrix[..., 2, 1] = 2 * (q2 * q3 + q0 * q1)
+    rot_matrix[..., 2, 2] = 2 * (q0 * q0 + q3 * q3) - 1
 
     return rot_matrix
 
 
 def get_extrinsic_matrix(camera_poses):
-
-    quat = camera_poses[:4]
-    translation = camera_poses[4:]
+    # camera_poses can be a single pose (quaternion + translation) or an (N,7)
+    # array of them, giving a (4,4) or an (N,4,4) array of extrinsic matrices
+    camera_poses = np.asarray(camera_poses)
+    quat = camera_poses[..., :4]
+    translation = camera_poses[..., 4:]
 
     # Convert quaternion to rotation matrix
     # R = quaternion_rotation_matrix(quat)
     R = quaternion_to_rotation_matrix(quat)
 
-    mx = np.eye(4)
-    mx[:3, :3] = R
-    mx[:3, 3] = translation
+    mx = np.zeros(camera_poses.shape[:-1] + (4, 4))
+    mx[..., :3, :3] = R
+    mx[..., :3, 3] = translation
+    mx[..., 3, 3] = 1
 
     return mx
 
@@ -143,14 +167,17 @@ def project_3d_2d(points_3d, frame_pos, T_global_origin, K):
 
     T_frame = get_extrinsic_matrix(frame_pos)
 
-    points_homogeneous = np.hstack((points_3d, np.ones((points_3d.shape[0], 1))))
-    T_relative = np.linalg.inv(T_frame)
-    points_camera = np.dot(T_relative, points_homogeneous.T).T[:, :3]
+    # The extrinsic matrix is a rigid transform, so its inverse is [R.T | -R.T t]
+    # and the points don't need to be made homogeneous
+    # project in the precision of the point cloud (the 4x4 pose itself stays float64)
+    R = T_frame[:3, :3].astype(points_3d.dtype)
+    t = T_frame[:3, 3].astype(points_3d.dtype)
+    points_camera = (points_3d - t) @ R
 
     # print(points_camera.shape)
 
-    uvw = np.dot(K, points_camera.T).T
-    uv = (uvw[:, :2] / uvw[:, 2].reshape(-1, 1))
+    uvw = points_camera @ K.T.astype(points_3d.dtype)
+    uv = uvw[:, :2] / uvw[:, 2:3]
 
     # exit()
     ######################
@@ -178,20 +205,23 @@ def project_3d_2d(points_3d, frame_pos, T_global_origin, K):
 
 
 def construct_frames(uv, point_cloud, lbls, oimage):
-    frame_coords_idx = []
     im_frame = np.zeros((480, 640), dtype=np.uint8)
-    xyz_frame = np.zeros((480, 640, 3), dtype=float)
-    xy_frame = np.zeros((480, 640, 2), dtype=float)
-    test_frame = np.zeros((480, 640, 2), dtype=float)
-
-    for uv_idx, point in enumerate(uv):
-        x, y = map(int, point)
-        if 0 <= x < 640 and 0 <= y < 480:
-            im_frame[y, x] = int(lbls[uv_idx])  # Set pixel to white
-            xyz_frame[y, x, :] = point_cloud[uv_idx]
-            xy_frame[y, x, :] = uv[uv_idx]
-            frame_coords_idx.append(uv_idx)
-            test_frame = point_cloud[uv_idx, :2] #
+    xyz_frame = np.zeros((480, 640, 3), dtype=np.float32)
+    xy_frame = np.zeros((480, 640, 2), dtype=np.float32)
+    test_frame = np.zeros((480, 640, 2), dtype=np.float32)
+
+    # pixel of each projected point (truncated like int()), keeping only those inside the frame
+    with np.errstate(invalid='ignore'):
+        xy = uv.astype(np.int64)
+    x, y = xy[:, 0], xy[:, 1]
+    in_frame = (x >= 0) & (x < 640) & (y >= 0) & (y < 480) & np.isfinite(uv).all(axis=1)
+    xs, ys = x[in_frame], y[in_frame]
+
+    # scatter all points at once; where points share a pixel the last one is kept
+    im_frame[ys, xs] = lbls[in_frame].astype(np.uint8)
+    xyz_frame[ys, xs] = point_cloud[in_frame]
+    xy_frame[ys, xs] = uv[in_frame]
+    test_frame[ys, xs] = point_cloud[in_frame, :2]
 
     # plt.imshow(oimage)
     # plt.imshow(im_frame, alpha=0.3)
@@ -203,33 +233,34 @@ def construct_frames(uv, point_cloud, lbls, oimage):
 def clean_label_mask(im_frame, oimg, prev_objs=None, prev_lbls=None):
     imgs = []
     imgs_lbls = []
-    uniques = set(np.unique(im_frame)) - {0,10} # remove cases of 0 (no label) and 10 (background)
-
-    for un in uniques:
-        mask = np.zeros_like(im_frame).astype(bool)
-        idx = np.where(im_frame == un)
-        mask[idx] = True
-        footprint = disk(6)
-        mask = closing(mask, footprint)
-        fmask = remove_small_objects(mask, 30)
-
-        # plt.imshow(oimg)
-        # plt.imshow(fmask, alpha=0.5)
-        # plt.imshow(XA[1],alpha=0.3)
-        # plt.show()
-        label_image = label(fmask)
+    uniques = list(set(np.unique(im_frame)) - {0,10}) # remove cases of 0 (no label) and 10 (background)
+
+    # Stack a mask per label so each step below is a single pass over all of them.
+    # The structuring elements are flat, so the masks don't affect each other.
+    masks = im_frame[None, :, :] == np.array(uniques, dtype=im_frame.dtype)[:, None, None]
+    masks = closing(masks, disk(6)[None, :, :])
 
+    # Remove objects smaller than 30 pixels (4-connected, like remove_small_objects)
+    cross = np.zeros((3, 3, 3), dtype=bool)
+    cross[1] = ndi.generate_binary_structure(2, 1)
+    components, _ = ndi.label(masks, structure=cross)
+    masks[np.bincount(components.ravel())[components] < 30] = False
+
+    # plt.imshow(oimg)
+    # plt.imshow(masks[0], alpha=0.5)
+    # plt.show()
+    # Label the objects of each mask (8-connected, like skimage's label)
+    square = np.zeros((3, 3, 3), dtype=bool)
+    square[1] = True
+    label_images, _ = ndi.label(masks, structure=square)
+
+    for un, label_image in zip(uniques, label_images):
         lbl_uniqe = np.unique(label_image)
-        for lblidx in lbl_uniqe[1:]:
-            tmp_im = np.zeros_like(label_image)
-            tmp_im[label_image == lblidx] = 1
+        # the objects of each label are numbered in order, starting at 1
+        for suffix, lblidx in enumerate(lbl_uniqe[1:], start=1):
+            tmp_im = (label_image == lblidx).astype(label_image.dtype)
             imgs.append(tmp_im)
-            prev_suffixes = sorted([int(l.split('_')[1]) for l in imgs_lbls if l.startswith(str(un)) and '_' in l])
-            if len(prev_suffixes)==0:
-                suffix = '_1'
-            else:
-                suffix = '_'+str(int(prev_suffixes[-1]+1))
-            imgs_lbls.append(str(un)+suffix)
+            imgs_lbls.append(str(un)+'_'+str(suffix))
 
     # Drop any objects that take up too few pixels in the frame - these appear to be a glitch
     pixel_counts = [np.count_nonzero(im) for im in imgs]
@@ -242,6 +273,12 @@ def clean_label_mask(im_frame, oimg, prev_objs=None, prev_lbls=None):
         imgs_lbls_og = imgs_lbls.copy() # Save initially identified imgs_lbls
         unique_labels = sorted(list(set([l.split('_')[0] for l in imgs_lbls+prev_lbls])))
 
+        # Pack every mask into bits and find its centroid once, rather than once per label
+        packed_imgs = np.packbits(np.array(imgs).reshape(len(imgs), im_frame.size) != 0, axis=1)
+        packed_prev = np.packbits(np.array(prev_objs).reshape(len(prev_objs), im_frame.size) != 0, axis=1)
+        centroids_imgs = np.array([np.array(np.where(obj)).T.mean(axis=0) for obj in imgs]).reshape(-1, 2)
+        centroids_prev = np.array([np.array(np.where(obj)).T.mean(axis=0) for obj in prev_objs]).reshape(-1, 2)
+
         for lbl in unique_labels:
             # Find indices of current label in current and previous sets
             prev_lbl_idx = [i for i, l in enumerate(prev_lbls) if l.startswith(lbl)]
@@ -250,19 +287,15 @@ def clean_label_mask(im_frame, oimg, prev_objs=None, prev_lbls=None):
                 # if the label only existed in one frame but not the other (current or previous)
                 continue # skip to the next label
 
-            # Create input arrays for jaccard similarity scoring
-            XA = np.take(np.array(imgs), curr_lbl_idx, axis=0)
-            XB = np.take(np.array(prev_objs), prev_lbl_idx, axis=0)
-
             # Calculate similarity scores between objects in the current and previous frames
-            jaccard_dist = cdist(XA.reshape(XA.shape[0], -1), XB.reshape(XB.shape[0], -1), metric='jaccard')
+            jaccard_dist = jaccard_distance(packed_imgs[curr_lbl_idx], packed_prev[prev_lbl_idx])
 
             # Because we are comparing sequential frames of a video, we can improve matching by
             # building in the assumption that objects tend to have a gradual progression from one
             # frame to the next rather than bouncing around. We do this by adding a spatial
             # penalty based on the Euclidean distance between object centroids.
-            centroids_A = np.array([np.array(np.where(obj)).T.mean(axis=0) for obj in XA])
-            centroids_B = np.array([np.array(np.where(obj)).T.mean(axis=0) for obj in XB])
+            centroids_A = centroids_imgs[curr_lbl_idx]
+            centroids_B = centroids_prev[prev_lbl_idx]
             spatial_penalty = cdist(centroids_A, centroids_B, metric='euclidean') * 0.001
 
             # Combine Jaccard distance and spatial penalty
@@ -280,11 +313,15 @@ def clean_label_mask(im_frame, oimg, prev_objs=None, prev_lbls=None):
                     img_lbl = imgs_lbls_og[curr_lbl_idx[i]].split('_')[0]
                 imgs_lbls[idx] = img_lbl
 
-            not_suffixed = [l for l in imgs_lbls if '_' not in l]
-            for prefix in not_suffixed:
-                suffixes = [int(l.split('_')[1]) for l in imgs_lbls if '_' in l and l.startswith(prefix)]
-                max_suff = max(suffixes) if suffixes else 0
-                img_lbl = prefix+'_'+str(max_suff+1)
-                imgs_lbls[imgs_lbls.index(prefix)] = img_lbl
+            # Number each unsuffixed label after the highest suffix of its prefix so far
+            max_suffix = {}
+            for l in imgs_lbls:
+                if '_' in l:
+                    prefix, suff = l.split('_')[:2]
+                    max_suffix[prefix] = max(max_suffix.get(prefix, 0), int(suff))
+            for idx, prefix in enumerate(imgs_lbls):
+                if '_' not in prefix:
+                    max_suffix[prefix] = max_suffix.get(prefix, 0) + 1
+                    imgs_lbls[idx] = prefix+'_'+str(max_suffix[prefix])
 
     return imgs, imgs_lbls
@@ -0,0 +1,39 @@
+import numpy as np
+
+from modules.prepare_data import objectDistances
+
+
+def test_objectDistances_bracketed_names(tmp_path):
+    names = ["['plaque: [0.15,1,0.1,1] white 1', '1']",
+             "['sofa: [2,1,1,1] short', '2']",
+             "['lamp (desk)', '3']"]
+    lines = [names[0],'(3.0, 4.0, 0.0)',
+             names[1],'(0.0, 0.0, 2.0)','(0.0, 0.0, 1e-05)',
+             names[2],'(1.0, 0.0, 0.0)']
+    path = tmp_path/'1.3d'
+    path.write_text('\n'.join(lines)+'\n')
+
+    # keys as calculateCentroidsForScene writes them to centroids.csv
+    # (parentheses in names become square brackets)
+    keys = ["['plaque: [0.15,1,0.1,1] white 1', '1']",
+            "['sofa: [2,1,1,1] short', '2']",
+            "['lamp [desk]', '3']"]
+    centroids = {key:np.zeros(3) for key in keys}
+    distances = objectDistances(str(path),centroids,'centroids.csv')
+
+    assert list(distances) == ['plaque:_[0.15,1,0.1,1]_white_1','sofa:_[2,1,1,1]_short','lamp_[desk]']
+    np.testing.assert_allclose(distances['plaque:_[0.15,1,0.1,1]_white_1'][0],[5.0])
+    np.testing.assert_allclose(distances['sofa:_[2,1,1,1]_short'][0],[2.0,1e-05])
+    np.testing.assert_allclose(distances['lamp_[desk]'][0],[1.0])
+
+
+def test_objectDistances_name_after_point(tmp_path):
+    # older .3d files can have a name on the same line as the previous point
+    path = tmp_path/'1.3d'
+    path.write_text("['chair', '1']\n(1.0, 0.0, 0.0)['table', '2']\n(0.0, 2.0, 0.0)\n")
+
+    centroids = {"['chair', '1']":np.zeros(3),"['table', '2']":np.zeros(3)}
+    distances = objectDistances(str(path),centroids,'centroids.csv')
+
+    np.testing.assert_allclose(distances['chair'][0],[1.0])
+    np.testing.assert_allclose(distances['table'][0],[2.0])
@@ -0,0 +1,16 @@
+import numpy as np
+
+from modules.utils import clean_label_mask
+
+
+def test_clean_label_mask_suffixes_prefix_labels():
+    # label 3 is a prefix of label 33; each is numbered on its own
+    im_frame = np.zeros((100, 100), dtype=np.uint8)
+    im_frame[10:30, 10:30] = 33
+    im_frame[10:30, 60:80] = 3
+    im_frame[60:80, 60:80] = 3
+
+    imgs, imgs_lbls = clean_label_mask(im_frame, None)
+
+    assert sorted(imgs_lbls) == ['33_1', '3_1', '3_2']
+    assert len(imgs) == 3